@@ -0,0 +1,50 @@
+"""
+Compare the memory and lookup speed of the 'list' and 'array' L1 engines at
+equal capacity::
+
+    python benchmarks/l1_engine.py --maxsize 100000
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+settings.configure(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+
+from lru2cache import utils
+
+
+def measure(engine, maxsize, lookups):
+    @utils.lru2cache(l1_maxsize=maxsize, l2cache_name='default', l1_engine=engine)
+    def f(x):
+        return x
+
+    for x in range(maxsize):
+        f(x)
+    hits = [x % maxsize for x in range(0, lookups * 7919, 7919)]
+
+    def lookup():
+        for x in hits:
+            f(x)
+    seconds = min(timeit.repeat(lookup, number=1, repeat=5))
+    assert f.cache_info().l1_currsize == maxsize
+    return f.l1_entry_bytes(), seconds / lookups
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--maxsize', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args(argv)
+    print('{0:>8} {1:>16} {2:>16}'.format('engine', 'bytes per entry', 'us per hit'))
+    for engine in 'list', 'array':
+        entry_bytes, seconds = measure(engine, args.maxsize, args.lookups)
+        print('{0:>8} {1:>16.1f} {2:>16.3f}'.format(engine, entry_bytes, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+from __future__ import unicode_literals
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_replace = getattr(os, 'replace', os.rename)
+ATIME_RESOLUTION = 60           # seconds between updates of a result's access time
+EVICT_BATCH = 64                # least recently accessed results read per eviction query
+BUSY_TIMEOUT = 0.05             # seconds to wait for the index before skipping a write
+
+
+class DiskCache(object):
+    """A byte budgeted cache of results stored in files under *directory*.
+
+    Each result is written to its own file, with an SQLite index recording its
+    size and when it was last accessed.  Files are written to a temporary name
+    and renamed into place, so readers in other processes never see a partial
+    result, and a file removed by another process's eviction remains readable
+    by anyone who already has it mapped.
+
+    When the files exceed *maxbytes* the least recently accessed results are
+    removed.  Results smaller than *min_bytes* are not stored.  If *zero_copy* is
+    True bytes results are returned as a read only memoryview of the mapped file
+    rather than being copied into memory.
+
+    Access times are only updated once per ATIME_RESOLUTION, so that readers
+    rarely need the index's write lock, and writes that can't get the lock within
+    BUSY_TIMEOUT are skipped rather than delaying the call.  Failures to store or
+    delete a result, such as a full disk or an unpicklable result, are ignored.
+    """
+
+    def __init__(self, directory, maxbytes, min_bytes=0, zero_copy=False):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.min_bytes = min_bytes
+        self.zero_copy = zero_copy
+        self._local = threading.local()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created concurrently by another process
+                if not os.path.isdir(directory):
+                    raise
+        # creating the schema may wait on other processes, unlike the request path
+        connection = sqlite3.connect(self._index(), timeout=30, isolation_level=None)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                               'key TEXT PRIMARY KEY, size INTEGER, raw INTEGER, atime REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)')
+            # a running total of the bytes stored, maintained by triggers
+            connection.execute('CREATE TABLE IF NOT EXISTS total (bytes INTEGER)')
+            connection.execute('INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM entries '
+                               'WHERE NOT EXISTS (SELECT 1 FROM total)')
+            connection.execute('CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries '
+                               'BEGIN UPDATE total SET bytes = bytes + new.size; END')
+            connection.execute('CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries '
+                               'BEGIN UPDATE total SET bytes = bytes - old.size; END')
+        finally:
+            connection.close()
+
+    def _index(self):
+        return os.path.join(self.directory, 'index.sqlite3')
+
+    def _connection(self):
+        # sqlite connections may not be shared between threads or across a fork
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            local.connection = sqlite3.connect(self._index(), timeout=BUSY_TIMEOUT, isolation_level=None)
+            local.pid = pid
+        return local.connection
+
+    def _execute(self, sql, params=()):
+        return self._connection().execute(sql, params)
+
+    def _executemany(self, statements):
+        'Execute (sql, params) statements in a single transaction'
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, params in statements:
+                connection.execute(sql, params)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{k}.l3'.format(k=key))
+
+    def get(self, key):
+        """Return the result stored for *key*, or None if there isn't one"""
+        key = '{k}'.format(k=key)
+        try:
+            row = self._execute('SELECT size, raw, atime FROM entries WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        size, raw, atime = row
+        try:
+            with open(self._path(key), 'rb') as f:
+                if size:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    mapped = b''
+        except (IOError, OSError, ValueError):
+            # evicted by another process since the index was read
+            return None
+        now = time.time()
+        if now - atime > ATIME_RESOLUTION:
+            try:
+                self._execute('UPDATE entries SET atime = ? WHERE key = ?', (now, key))
+            except sqlite3.Error:
+                # the index is busy, the access time is only used to order eviction
+                pass
+        if not raw:
+            try:
+                return pickle.loads(mapped[:])
+            except Exception:
+                return None
+        if self.zero_copy:
+            return memoryview(mapped)
+        return mapped[:]
+
+    def set(self, key, result):
+        """Store *result* for *key* and evict results until within budget"""
+        key = '{k}'.format(k=key)
+        raw = isinstance(result, (bytes, bytearray, memoryview))
+        try:
+            if isinstance(result, memoryview):
+                data = result.tobytes()
+            elif raw:
+                data = bytes(result)
+            else:
+                data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # the result can't be pickled, it's simply not stored
+            return
+        if not self.min_bytes <= len(data) <= self.maxbytes:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                _replace(tmp, self._path(key))
+            except (IOError, OSError):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+            # delete rather than replace any existing row so the delete trigger fires
+            self._executemany([
+                ('DELETE FROM entries WHERE key = ?', (key,)),
+                ('INSERT INTO entries (key, size, raw, atime) VALUES (?, ?, ?, ?)',
+                 (key, len(data), int(raw), time.time())),
+            ])
+            self._evict()
+        except (IOError, OSError, sqlite3.Error):
+            # failing to store a result in an optional tier should not fail the call
+            return
+
+    def delete(self, key):
+        key = '{k}'.format(k=key)
+        try:
+            self._execute('DELETE FROM entries WHERE key = ?', (key,))
+        except sqlite3.Error:
+            pass
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def currbytes(self):
+        """Return the bytes stored, or None if the index can't be read"""
+        try:
+            return self._currbytes()
+        except sqlite3.Error:
+            return None
+
+    def _currbytes(self):
+        return self._execute('SELECT bytes FROM total').fetchone()[0]
+
+    def _evict(self):
+        excess = self._currbytes() - self.maxbytes
+        while excess > 0:
+            rows = self._execute('SELECT key, size FROM entries ORDER BY atime LIMIT ?',
+                                 (EVICT_BATCH,)).fetchall()
+            if not rows:
+                return
+            evicted = []
+            for key, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append(key)
+                excess -= size
+            self._executemany(('DELETE FROM entries WHERE key = ?', (key,)) for key in evicted)
+            for key in evicted:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
@@ -0,0 +1,46 @@
+from __future__ import unicode_literals
+from .trace import _digest
+
+
+class CountMinSketch(object):
+    """Estimates how often each key has been added in a fixed amount of memory.
+
+    Estimates may exceed the true count, but never fall short of it.  Every
+    *decay_interval* additions all counts are halved, so keys that are no longer
+    being accessed gradually stop looking frequent.
+    """
+
+    def __init__(self, width=1024, depth=4, decay_interval=None):
+        self.width = width
+        self.depth = depth
+        self.decay_interval = decay_interval or width * 10
+        self.clear()
+
+    def clear(self):
+        self.tables = [[0] * self.width for i in range(self.depth)]
+        self.additions = 0
+
+    def _indexes(self, key):
+        # derive each row's index from two halves of the key's digest
+        digest = _digest(key)
+        h1, h2 = digest & 0xffffffff, (digest >> 32) | 1
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, key):
+        """Count an occurrence of *key* and return its new estimated count"""
+        indexes = self._indexes(key)
+        tables = self.tables
+        # conservative update, only raise the counters that are at the minimum
+        count = min(table[i] for table, i in zip(tables, indexes)) + 1
+        for table, i in zip(tables, indexes):
+            if table[i] < count:
+                table[i] = count
+        self.additions += 1
+        if self.additions >= self.decay_interval:
+            self.additions = 0
+            self.tables = [[c >> 1 for c in table] for table in tables]
+        return count
+
+    def estimate(self, key):
+        return min(table[i] for table, i in zip(self.tables, self._indexes(key)))
@@ -0,0 +1,17 @@
+from __future__ import unicode_literals
+from . import utils
+
+
+class RequestCacheMiddleware(object):
+    """Enables the request scoped L0 cache of lru2cache decorated functions for the
+    duration of each request.  See utils.request_cache()."""
+
+    def process_request(self, request):
+        utils._request_local.cache = {}
+
+    def process_response(self, request, response):
+        utils._request_local.cache = None
+        return response
+
+    def process_exception(self, request, exception):
+        utils._request_local.cache = None
@@ -0,0 +1,110 @@
+"""
+Replay a trace recorded with lru2cache(trace_file=...) against simulated L1 and
+L2 caches to estimate the hit rates and latency of different settings::
+
+    python -m lru2cache.replay trace.bin --sizes 0,64,128,1024,None
+
+Each process in the trace has its own simulated L1 LRU cache while the L2 cache
+is shared and assumed never to evict.  None results are never found in the L2
+cache, so --none-cache only affects L1.  Since keys are sampled, each L1 size is
+scaled by the sample rate before simulating.
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+from collections import namedtuple, OrderedDict, defaultdict
+from .trace import read_trace, L2, COMPUTED
+
+SimulationResult = namedtuple("SimulationResult", ["function", "l1_maxsize", "calls", "l1_hits", "l2_hits",
+                                                   "misses", "latency"])
+
+
+def _costs(accesses, default_l2_latency):
+    'Measure compute costs per key and mean compute and L2 latency per function'
+    key_costs = {}
+    totals = defaultdict(lambda: [0.0, 0, 0.0, 0])   # compute total, count, l2 total, count
+    for record, rate in accesses:
+        total = totals[record.function]
+        if record.tier == COMPUTED:
+            key_costs[record.function, record.digest] = record.cost
+            total[0] += record.cost
+            total[1] += 1
+        elif record.tier == L2:
+            total[2] += record.cost
+            total[3] += 1
+    means = {}
+    for function, (compute, computed, l2, l2_hits) in totals.items():
+        means[function] = (compute / computed if computed else 0.0,
+                           l2 / l2_hits if l2_hits else default_l2_latency)
+    return key_costs, means
+
+
+def simulate(accesses, l1_maxsize, none_cache=False, l2_latency=0.001):
+    """Simulate the L1 and L2 caches for a list of (TraceRecord, rate) pairs, as
+    returned by read_trace, and return a SimulationResult for each function"""
+    key_costs, means = _costs(accesses, l2_latency)
+    l1_caches = {}
+    l2_cache = set()
+    stats = defaultdict(lambda: [0, 0, 0, 0, 0.0])    # calls, l1 hits, l2 hits, misses, latency
+    for record, rate in accesses:
+        function, digest = record.function, record.digest
+        compute_latency, function_l2_latency = means[function]
+        stat = stats[function]
+        stat[0] += 1
+        if record.none_result and not none_cache:
+            # None results are never cached
+            stat[3] += 1
+            stat[4] += key_costs.get((function, digest), compute_latency)
+            continue
+        l1 = l1_caches.get((function, record.pid))
+        if l1 is None:
+            l1 = l1_caches[function, record.pid] = OrderedDict()
+        if digest in l1:
+            l1[digest] = l1.pop(digest)
+            stat[1] += 1
+            continue
+        if (function, digest) in l2_cache:
+            stat[2] += 1
+            stat[4] += function_l2_latency
+        else:
+            stat[3] += 1
+            stat[4] += key_costs.get((function, digest), compute_latency)
+            if not record.none_result:
+                # a None from the L2 cache is a miss, so none_cache only affects L1
+                l2_cache.add((function, digest))
+        if l1_maxsize is None:
+            l1[digest] = True
+        elif l1_maxsize > 0:
+            if len(l1) >= max(1, int(round(l1_maxsize * rate))):
+                l1.popitem(last=False)
+            l1[digest] = True
+    return [SimulationResult(function, l1_maxsize, calls, l1_hits, l2_hits, misses, latency / calls)
+            for function, (calls, l1_hits, l2_hits, misses, latency) in sorted(stats.items())]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('trace', help='trace file recorded with lru2cache(trace_file=...)')
+    parser.add_argument('--sizes', default='0,16,64,128,256,1024,None',
+                        help='comma separated l1_maxsize values to simulate')
+    parser.add_argument('--none-cache', action='store_true', help='simulate none_cache=True')
+    parser.add_argument('--l2-latency', type=float, default=0.001,
+                        help='seconds per L2 hit for functions without L2 hits in the trace')
+    args = parser.parse_args(argv)
+    sizes = [None if size == 'None' else int(size) for size in args.sizes.split(',')]
+    accesses = list(read_trace(args.trace))
+
+    results = defaultdict(list)
+    for size in sizes:
+        for result in simulate(accesses, size, args.none_cache, args.l2_latency):
+            results[result.function].append(result)
+    for function in sorted(results):
+        print(function)
+        print('  {0:>10} {1:>10} {2:>8} {3:>8} {4:>12}'.format('l1_maxsize', 'calls', 'l1 hit', 'l2 hit', 'latency ms'))
+        for result in results[function]:
+            print('  {0:>10} {1:>10} {2:>8.1%} {3:>8.1%} {4:>12.3f}'.format(
+                '{0}'.format(result.l1_maxsize), result.calls, float(result.l1_hits) / result.calls,
+                float(result.l2_hits) / result.calls, result.latency * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+from __future__ import unicode_literals
+import os
+import struct
+import sys
+import threading
+import zlib
+from collections import namedtuple
+
+# each access is a fixed size record of the process id, function id, key digest,
+# tier and flags, result size and the seconds it took to obtain the result
+_record = struct.Struct(str('<IIQBIf'))
+L1, L2, L3, COMPUTED = 1, 2, 3, 4       # tier the result was found in
+NONE_RESULT = 0x80                      # flag set when the result was None
+TIER_MASK = 0x0f
+# a function record maps a function id to its name, which follows the record,
+# and records the sample rate in place of the cost
+FUNCTION = 0x7f
+SIZEOF_LIMIT = 1000             # most objects visited when estimating the size of a result
+
+try:
+    _integer_types = (int, long)
+except NameError:
+    _integer_types = (int,)
+
+TraceRecord = namedtuple("TraceRecord", ["pid", "function", "digest", "tier", "none_result", "size", "cost"])
+
+
+def _sizeof(result, getsizeof=sys.getsizeof, id=id, isinstance=isinstance):
+    'Estimate the memory used by a result and the objects it contains'
+    size = 0
+    seen = set()
+    stack = [result]
+    while stack and len(seen) < SIZEOF_LIMIT:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return size
+
+
+def _digest(key):
+    'Reduce a cache key from _make_key to 64 bits'
+    if isinstance(key, _integer_types):
+        return key & 0xffffffffffffffff
+    return int(key[:16], 16)
+
+
+class TraceWriter(object):
+    """Appends a sample of cache accesses to a binary trace file.
+
+    Keys are sampled by their digest, so either every access to a key is recorded
+    or none are, at approximately *rate* of all keys.  Each access is written
+    with a single append so several processes may share a trace file.  Result
+    sizes are estimated by walking at most SIZEOF_LIMIT contained objects.
+    Failures to write the trace are ignored.
+    """
+
+    def __init__(self, path, rate):
+        self.path = path
+        self.rate = rate
+        self.threshold = int(rate * 0x100000000)
+        self._pid = None
+        self._fd = None
+        self._functions = set()
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # reopen after a fork so each process records its own pid.  the pid is
+        # published last, so other threads never see it before the fd
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            except (IOError, OSError):
+                fd = None
+            self._functions = set()
+            self._fd = fd
+            self._pid = pid
+
+    def record(self, name, key, tier, result, cost):
+        digest = _digest(key)
+        if digest & 0xffffffff >= self.threshold:
+            return
+        if self._pid != os.getpid():
+            self._open()
+        fd = self._fd
+        if fd is None:
+            return
+        function = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+        if result is None:
+            tier |= NONE_RESULT
+        try:
+            if function not in self._functions:
+                encoded = name.encode('utf-8')
+                os.write(fd, _record.pack(self._pid, function, 0, FUNCTION, len(encoded), self.rate) + encoded)
+                self._functions.add(function)
+            os.write(fd, _record.pack(self._pid, function, digest, tier,
+                                      min(_sizeof(result), 0xffffffff), cost))
+        except (IOError, OSError):
+            # tracing is only diagnostic, it must never fail the call
+            pass
+
+
+def read_trace(path):
+    """Yield a TraceRecord, with the function name in place of its id, and the
+    sample rate it was recorded with for each access in a trace file"""
+    names = {}
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(_record.size)
+            if len(data) < _record.size:
+                return
+            pid, function, digest, flags, size, cost = _record.unpack(data)
+            if flags == FUNCTION:
+                names[function] = f.read(size).decode('utf-8'), cost
+                continue
+            name, rate = names.get(function, ('{f:08x}'.format(f=function), 1.0))
+            yield TraceRecord(pid, name, digest, flags & TIER_MASK, bool(flags & NONE_RESULT), size, cost), rate
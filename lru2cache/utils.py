@@ -1,17 +1,73 @@
 from __future__ import unicode_literals
 from django.core import cache
+from array import array
+from binascii import unhexlify
 from collections import namedtuple
+from contextlib import contextmanager
 from functools import update_wrapper
-from threading import RLock
+from heapq import heappush, heappop, heapify
+from itertools import count
+from random import randrange
+from sys import getsizeof
+from threading import RLock, local
+from timeit import default_timer as _timer
 try:
     from spooky import hash128 as hash
 except:
     from hashlib import sha256
     hash = lambda x: sha256(x).hexdigest()
 import inspect
+from .disk import DiskCache
+from .hotkeys import CountMinSketch
+from . import trace
+from .trace import _integer_types
 
 
 _CacheInfo = namedtuple("CacheInfo", ["l1_hits", "l1_misses", "l2_hits", "l2_misses", "l1_maxsize", "l1_currsize"])
+_CacheInfoL3 = namedtuple("CacheInfo", _CacheInfo._fields + ("l3_hits", "l3_misses", "l3_latency",
+                                                            "l3_maxbytes", "l3_currbytes"))
+
+_request_local = local()        # holds the L0 cache of the current request, if any
+
+
+@contextmanager
+def request_cache():
+    """Cache results in a dict for the duration of the block, in front of the L1 cache
+    of every lru2cache decorated function called by this thread.  Nested blocks share the
+    outermost cache, which is discarded when it exits."""
+    if getattr(_request_local, 'cache', None) is not None:
+        yield
+        return
+    _request_local.cache = {}
+    try:
+        yield
+    finally:
+        _request_local.cache = None
+
+
+def _make_l0_key(user_function, args, kwds, inst_attr='id',
+                 scalartypes=frozenset((bool, bytes, type(''), type(None)) + _integer_types),
+                 sorted=sorted, tuple=tuple, type=type, repr=repr, getattr=getattr):
+    """Make a cheap key, only valid within a single process, for the L0 cache.
+
+    The key is never coarser than the one from _make_key, which distinguishes
+    arguments by their repr, so values that are equal but have different types
+    or reprs, such as 3, 3.0 and True, or 0.0 and -0.0, are kept apart."""
+    key = [user_function]
+    for i, arg in enumerate(args):
+        arg_type = type(arg)
+        if arg_type in scalartypes:
+            key += (arg_type, arg)
+        elif i == 0 and inspect.ismethod(getattr(arg, user_function.__name__, None)):
+            # the instance of a method, which _make_key distinguishes by its class and inst_attr
+            key += (arg_type, getattr(arg, inst_attr, None), arg)
+        else:
+            key += (arg_type, repr(arg))
+    if kwds:
+        for k, v in sorted(kwds.items()):
+            v_type = type(v)
+            key += (k, v_type, v if v_type in scalartypes else repr(v))
+    return tuple(key)
 
 
 def _make_key(user_function, args, kwds, typed,
@@ -41,8 +97,18 @@ def _make_key(user_function, args, kwds, typed,
     return hash(str(key).encode('utf-8'))
 
 
+def _compact_key(key, unhexlify=unhexlify, isinstance=isinstance, integer_types=_integer_types):
+    'Convert a hex digest key from _make_key to the smaller, equivalent, bytes'
+    if isinstance(key, integer_types):
+        return key
+    return unhexlify(key)
+
+
 
-def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cache', inst_attr='id'):
+def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cache', inst_attr='id',
+              l1_policy='lru', l2_min_cost=0, l3_dir=None, l3_maxbytes=1024 * 1024 * 1024,
+              l3_min_bytes=64 * 1024, l3_min_cost=0.1, l3_zero_copy=False, trace_file=None, trace_rate=0.01, hot_threshold=None, hot_maxpins=32,
+              l2_replicas=1, l1_engine='list'):
     """Least-recently-used cache decorator.
 
     If *l1_maxsize* is set to None, the LRU features are disabled and the cache
@@ -54,9 +120,40 @@ def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cac
 
     Arguments to the cached function must be hashable.
 
+    Within a request_cache() block results are also cached in a dict for the
+    duration of the block, keyed by the arguments themselves.
+
+    If *l1_policy* is 'gd' a size limited L1 cache is evicted using GreedyDual,
+    weighting each entry by the measured time it took to obtain its result,
+    rather than purely by recency.
+
+    Results that took less than *l2_min_cost* seconds to compute are not added
+    to the l2 cache, since they are cheaper to recompute than to fetch.
+
+    If *l1_engine* is 'array' a size limited, 'lru' policy, L1 cache tracks recency with
+    preallocated arrays of link indexes, and stores keys as ints, rather than a
+    list per entry.  View the bytes used per entry with f.l1_entry_bytes().
+
+    If *l3_dir* is set, results are also stored in files under that directory,
+    limited to *l3_maxbytes*, which is checked after L1 and before the l2 cache.
+    Only results of at least *l3_min_bytes* are stored, and computed results must
+    also have taken at least *l3_min_cost* seconds.
+    If *l3_zero_copy* is True bytes results read from it are returned as a
+    memoryview of the mapped file.
+
+    If *hot_threshold* is set, keys that miss L1 at least that often are pinned
+    in L1, up to *hot_maxpins* of the hottest, so they are no longer fetched from
+    the l2 cache after being evicted by the normal L1 eviction order.  If *l2_replicas* is more than 1, hot
+    keys are also stored under that many keys in the l2 cache, and reads are
+    spread across them.  View the pinned keys with f.hot_keys().
+
+    If *trace_file* is set, accesses to a sample of *trace_rate* of the keys are
+    appended to it, for replaying with ``python -m lru2cache.replay``.
+
     View the cache statistics named tuple (l1_hits, l1_misses, l2_hits, l2_misses,
     l1_maxsize, l1_currsize) with
-    f.cache_info().  Clear the cache and statistics with f.cache_clear().
+    f.cache_info(), which also has (l3_hits, l3_misses, l3_latency, l3_maxbytes,
+    l3_currbytes) when *l3_dir* is set.  Clear the cache and statistics with f.cache_clear().
     Access the underlying function with f.__wrapped__.
 
     See:  http://en.wikipedia.org/wiki/Cache_algorithms#Least_Recently_Used
@@ -71,13 +168,30 @@ def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cac
         l2cache = cache.get_cache(l2cache_name)
     except cache.backends.base.InvalidCacheBackendError:
         l2cache = cache.get_cache('default')
-
+    if l1_policy not in ('lru', 'gd'):
+        raise ValueError("l1_policy must be 'lru' or 'gd', not {p!r}".format(p=l1_policy))
+    if l1_policy == 'gd' and not l1_maxsize:
+        raise ValueError("l1_policy 'gd' requires a positive l1_maxsize")
+    if l1_engine not in ('list', 'array'):
+        raise ValueError("l1_engine must be 'list' or 'array', not {e!r}".format(e=l1_engine))
+    use_arrays = l1_engine == 'array'
+    if use_arrays and (l1_policy != 'lru' or not l1_maxsize):
+        raise ValueError("l1_engine 'array' requires l1_policy 'lru' and a positive l1_maxsize")
+    if l3_dir is not None:
+        l3cache = DiskCache(l3_dir, l3_maxbytes, min_bytes=l3_min_bytes, zero_copy=l3_zero_copy)
+    else:
+        l3cache = None
+    if trace_file is not None:
+        tracer = trace.TraceWriter(trace_file, trace_rate)
+    else:
+        tracer = None
 
     def decorating_function(user_function):
 
         cache = dict()
-        stats = [0, 0, 0, 0]                  # make statistics updateable non-locally
+        stats = [0, 0, 0, 0, 0, 0, 0]         # make statistics updateable non-locally
         L1_HITS, L1_MISSES, L2_HITS, L2_MISSES = 0, 1, 2, 3     # names for the stats fields
+        L3_HITS, L3_MISSES, L3_TIME = 4, 5, 6
         make_key = _make_key
         cache_get = cache.get           # bound method to lookup key or return None
         _len = len                      # localize the global len() function
@@ -86,13 +200,35 @@ def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cac
         root[:] = [root, root, None, None]      # initialize by pointing to self
         nonlocal_root = [root]                  # make updateable non-locally
         PREV, NEXT, KEY, RESULT = 0, 1, 2, 3    # names for the link fields
+        heap = []                               # GreedyDual eviction order
+        inflation = [0.0]                       # GreedyDual aging value, updateable non-locally
+        sequence = count()                      # tie breaker so keys are never compared
+        PRIORITY, COST, ENTRY = 0, 1, 2         # names for the GreedyDual link fields
+        if use_arrays:
+            # slot 0 of each array is the root of the circular doubly linked list
+            prevs = array(str('i'), [0]) * (l1_maxsize + 1)
+            nexts = array(str('i'), [0]) * (l1_maxsize + 1)
+            keys = [None] * (l1_maxsize + 1)
+            results = [None] * (l1_maxsize + 1)
+            free = list(range(l1_maxsize, 0, -1))     # unused slots
+        compact_key = _compact_key
+        trace_name = '{m}.{n}'.format(m=user_function.__module__, n=user_function.__name__)
+        pinned = dict()                         # hot keys kept beyond the L1 eviction order
+        if hot_threshold is not None:
+            sketch = CountMinSketch()           # estimated L1 misses per key
+        else:
+            sketch = None
 
         if l1_maxsize == 0:
 
             def wrapper(*args, **kwds):
                 # No l1 caching, only implements shared caching and tracks accesses
                 key = make_key(user_function, args, kwds, typed, inst_attr=inst_attr)
-                result = l2wrapper(key, user_function, none_cache, *args, **kwds)
+                if pinned:
+                    result = pinned_get(key)
+                    if result is not pinned:
+                        return result
+                result, cost = l2wrapper(key, user_function, none_cache, *args, **kwds)
                 stats[L1_MISSES] += 1
                 return result
 
@@ -104,13 +240,133 @@ def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cac
                 result = cache_get(key, root)   # root used here as a unique not-found sentinel
                 if result is not root:
                     stats[L1_HITS] += 1
+                    if tracer is not None:
+                        tracer.record(trace_name, key, trace.L1, result, 0.0)
                     return result
-                
-                result = l2wrapper(key, user_function, none_cache, *args, **kwds)
+                if pinned:
+                    result = pinned_get(key)
+                    if result is not pinned:
+                        return result
+
+                result, cost = l2wrapper(key, user_function, none_cache, *args, **kwds)
                 if none_cache or result is not None:
                     cache[key] = result
                 stats[L1_MISSES] += 1
                 return result
+        elif use_arrays:
+
+            def wrapper(*args, **kwds):
+                """ size limited L1 caching that tracks accesses by recency, as well as shared
+                caching.  The same as the linked list below, except that the links are indexes
+                into preallocated arrays, which needs far less memory per entry."""
+                key = make_key(user_function, args, kwds, typed, inst_attr=inst_attr)
+                l1key = compact_key(key)
+                with lock:
+                    slot = cache_get(l1key)
+                    if slot is not None:
+                        # record recent use of the key by moving it to the front of the list
+                        slot_prev, slot_next = prevs[slot], nexts[slot]
+                        nexts[slot_prev] = slot_next
+                        prevs[slot_next] = slot_prev
+                        last = prevs[0]
+                        nexts[last] = prevs[0] = slot
+                        prevs[slot] = last
+                        nexts[slot] = 0
+                        stats[L1_HITS] += 1
+                        result = results[slot]
+                if slot is not None:
+                    if tracer is not None:
+                        tracer.record(trace_name, key, trace.L1, result, 0.0)
+                    return result
+                if pinned:
+                    result = pinned_get(key)
+                    if result is not pinned:
+                        return result
+                result, cost = l2wrapper(key, user_function, none_cache, *args, **kwds)
+                if none_cache or result is not None:
+                    with lock:
+                        if l1key in cache:
+                            # added to the cache while the lock was released
+                            pass
+                        else:
+                            if free:
+                                slot = free.pop()
+                            else:
+                                # reuse the slot of the oldest link
+                                slot = nexts[0]
+                                slot_next = nexts[slot]
+                                nexts[0] = slot_next
+                                prevs[slot_next] = 0
+                                del cache[keys[slot]]
+                            keys[slot] = l1key
+                            results[slot] = result
+                            last = prevs[0]
+                            nexts[last] = prevs[0] = slot
+                            prevs[slot] = last
+                            nexts[slot] = 0
+                            cache[l1key] = slot
+                        stats[L1_MISSES] += 1
+                    return result
+                else:
+                    return result
+
+        elif l1_policy == 'gd':
+
+            def wrapper(*args, **kwds):
+                """ size limited L1 caching that evicts by GreedyDual, as well as shared caching.
+                Each entry's priority is the current inflation value plus the cost of obtaining
+                its result, so cheap results are evicted before expensive ones while entries
+                that are no longer used gradually age out as the inflation value rises."""
+                key = make_key(user_function, args, kwds, typed, inst_attr=inst_attr)
+                with lock:
+                    link = cache_get(key)
+                    if link is not None:
+                        # restore the priority of the entry.  its heap entry is left alone
+                        # and is only corrected lazily when it reaches the top of the heap
+                        link[PRIORITY] = inflation[0] + link[COST]
+                        stats[L1_HITS] += 1
+                        result = link[RESULT]
+                if link is not None:
+                    if tracer is not None:
+                        tracer.record(trace_name, key, trace.L1, result, 0.0)
+                    return result
+                if pinned:
+                    result = pinned_get(key)
+                    if result is not pinned:
+                        return result
+                result, cost = l2wrapper(key, user_function, none_cache, *args, **kwds)
+                if none_cache or result is not None:
+                    with lock:
+                        if key not in cache:
+                            while heap and _len(cache) >= l1_maxsize:
+                                priority, _, oldkey = entry = heappop(heap)
+                                link = cache_get(oldkey)
+                                if link is None or link[ENTRY] is not entry:
+                                    # orphaned by invalidate() or superseded
+                                    continue
+                                if link[PRIORITY] > priority:
+                                    # the entry was used since it was pushed, requeue it
+                                    link[ENTRY] = [link[PRIORITY], next(sequence), oldkey]
+                                    heappush(heap, link[ENTRY])
+                                    continue
+                                inflation[0] = priority
+                                try:
+                                    del cache[oldkey]
+                                except KeyError:
+                                    pass
+                            priority = inflation[0] + cost
+                            entry = [priority, next(sequence), key]
+                            cache[key] = [priority, cost, entry, result]
+                            heappush(heap, entry)
+                            if _len(heap) > 2 * l1_maxsize:
+                                # drop heap entries orphaned by invalidate()
+                                heap[:] = [link[ENTRY] for link in cache.values()]
+                                heapify(heap)
+                        stats[L1_MISSES] += 1
+                    return result
+                else:
+                    return result
+
         else:
 
             def wrapper(*args, **kwds):
@@ -131,8 +387,15 @@ def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cac
                         link[PREV] = last
                         link[NEXT] = root
                         stats[L1_HITS] += 1
+                if link is not None:
+                    if tracer is not None:
+                        tracer.record(trace_name, key, trace.L1, result, 0.0)
+                    return result
+                if pinned:
+                    result = pinned_get(key)
+                    if result is not pinned:
                         return result
-                result = l2wrapper(key, user_function, none_cache, *args, **kwds)
+                result, cost = l2wrapper(key, user_function, none_cache, *args, **kwds)
                 if none_cache or result is not None:
                     with lock:
                         root, = nonlocal_root
@@ -169,35 +432,168 @@ def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cac
                     return result
             
         def l2wrapper(key, user_function, none_cache, *args, **kwds):
-            result = l2cache.get(key)
+            """Returns the result along with the time in seconds it took to obtain it"""
+            start = _timer()
+            hot = False
+            if sketch is not None:
+                hits = sketch.add(key)
+                hot = hits >= hot_threshold
+
+            if l3cache is not None:
+                result = l3cache.get(key)
+                stats[L3_TIME] += _timer() - start
+                if result is not None:
+                    stats[L3_HITS] += 1
+                    cost = _timer() - start
+                    if tracer is not None:
+                        tracer.record(trace_name, key, trace.L3, result, cost)
+                    if hot:
+                        pin(key, result, hits)
+                    return result, cost
+                stats[L3_MISSES] += 1
+
+            result = None
+            l2key = key
+            if hot and l2_replicas > 1:
+                # spread reads of hot keys across replicas, which are likely on other shards
+                replica = randrange(l2_replicas)
+                if replica:
+                    l2key = replica_key(key, replica)
+                    result = l2cache.get(l2key)
+            if result is None:
+                result = l2cache.get(key)
+                if result is not None and l2key is not key:
+                    l2cache.add(l2key, result)
             if result is not None:
                 stats[L2_HITS] += 1
-                return result
+                cost = _timer() - start
+                if tracer is not None:
+                    tracer.record(trace_name, key, trace.L2, result, cost)
+                if l3cache is not None:
+                    l3cache.set(key, result)
+                if hot:
+                    pin(key, result, hits)
+                return result, cost
 
+            start = _timer()
             result = user_function(*args, **kwds)
+            cost = _timer() - start
+            if tracer is not None:
+                tracer.record(trace_name, key, trace.COMPUTED, result, cost)
             if none_cache or result is not None:
                 stats[L2_MISSES] += 1
-                l2cache.add(key, result)
-            return result   
+                if cost >= l2_min_cost:
+                    l2cache.add(key, result)
+                    if hot and l2_replicas > 1:
+                        l2cache.set_many(dict((replica_key(key, r), result) for r in range(1, l2_replicas)))
+                if l3cache is not None and cost >= l3_min_cost:
+                    l3cache.set(key, result)
+                if hot:
+                    pin(key, result, hits)
+            return result, cost
+
+        def pinned_get(key):
+            # hot keys are kept beyond the L1 eviction order, so a pinned key is an L1 hit.
+            # it is still counted, otherwise its estimate would fall behind colder keys
+            # that go on missing L1, which would displace it
+            result = pinned.get(key, pinned)    # pinned used here as a unique not-found sentinel
+            if result is not pinned:
+                sketch.add(key)
+                stats[L1_HITS] += 1
+                if tracer is not None:
+                    tracer.record(trace_name, key, trace.L1, result, 0.0)
+            return result
+
+        def replica_key(key, replica):
+            return '{k}:{r}'.format(k=key, r=replica)
+
+        def pin(key, result, hits):
+            # pin a hot key, displacing the coldest pinned key once the budget is used
+            with lock:
+                if key not in pinned and _len(pinned) >= hot_maxpins:
+                    if not pinned:
+                        return
+                    coldest = min(pinned, key=sketch.estimate)
+                    if sketch.estimate(coldest) >= hits:
+                        return
+                    del pinned[coldest]
+                pinned[key] = result
+
+        def l1_entry_bytes():
+            """Estimate the bytes used to track each L1 entry, excluding the results themselves"""
+            with lock:
+                if not cache:
+                    return 0.0
+                size = getsizeof(cache) + sum(getsizeof(key) for key in cache)
+                if use_arrays:
+                    size += getsizeof(prevs) + getsizeof(nexts) + getsizeof(keys) + getsizeof(results)
+                elif l1_maxsize is not None and l1_policy == 'gd':
+                    size += sum(getsizeof(link) + getsizeof(link[ENTRY]) for link in cache.values())
+                elif l1_maxsize is not None:
+                    size += sum(getsizeof(link) for link in cache.values())
+                return float(size) / len(cache)
+
+        def hot_keys():
+            """Report the pinned hot keys and their estimated L1 misses and pinned hits, hottest first"""
+            if sketch is None:
+                return []
+            with lock:
+                keys = list(pinned)
+            return sorted(((key, sketch.estimate(key)) for key in keys), key=lambda item: -item[1])
 
         def cache_info():
             """Report cache statistics.  This only affects the instance cache and dose not
             impact data stored in l2 Cache"""
             with lock:
-                return _CacheInfo(stats[L1_HITS], stats[L1_MISSES], stats[L2_HITS], stats[L2_MISSES], l1_maxsize, len(cache))
+                info = _CacheInfo(stats[L1_HITS], stats[L1_MISSES], stats[L2_HITS], stats[L2_MISSES], l1_maxsize, len(cache))
+                l3_stats = stats[L3_HITS], stats[L3_MISSES], stats[L3_TIME]
+            if l3cache is None:
+                return info
+            l3_hits, l3_misses, l3_time = l3_stats
+            l3_latency = l3_time / (l3_hits + l3_misses) if l3_hits + l3_misses else 0.0
+            return _CacheInfoL3(*(info + (l3_hits, l3_misses, l3_latency, l3_maxbytes, l3cache.currbytes())))
 
         def cache_clear():
             """Clear the cache and cache statistics.  This only affects the instance cache and dose not
             impact data stored in l2 Cache"""
+            l0 = getattr(_request_local, 'cache', None)
+            if l0:
+                for key in [key for key in l0 if key[0] is user_function]:
+                    del l0[key]
             with lock:
                 cache.clear()
                 root = nonlocal_root[0]
                 root[:] = [root, root, None, None]
-                stats[:] = [0, 0, 0, 0]
+                del heap[:]
+                inflation[0] = 0.0
+                pinned.clear()
+                if sketch is not None:
+                    sketch.clear()
+                if use_arrays:
+                    prevs[0] = nexts[0] = 0
+                    keys[:] = results[:] = [None] * (l1_maxsize + 1)
+                    free[:] = range(l1_maxsize, 0, -1)
+                stats[:] = [0, 0, 0, 0, 0, 0, 0]
                 
         def invalidate(*args, **kwds):
             """Delete a specific cache key if it exists"""
+            l0 = getattr(_request_local, 'cache', None)
+            if l0:
+                try:
+                    del l0[make_l0_key(user_function, args, kwds, inst_attr)]
+                except (KeyError, TypeError):
+                    pass
             key = make_key(user_function, args, kwds, typed, inst_attr=inst_attr)
+            if use_arrays:
+                with lock:
+                    slot = cache.pop(compact_key(key), None)
+                    if slot is not None:
+                        # unlink the slot and return it to the free list
+                        slot_prev, slot_next = prevs[slot], nexts[slot]
+                        nexts[slot_prev] = slot_next
+                        prevs[slot_next] = slot_prev
+                        keys[slot] = results[slot] = None
+                        free.append(slot)
             try:
                 del cache[key]
             except:
@@ -206,11 +602,43 @@ def lru2cache(l1_maxsize=128, none_cache=False, typed=False, l2cache_name='l2cac
                 l2cache.delete(key)
             except:
                 pass
-            
+            if l3cache is not None:
+                l3cache.delete(key)
+            if l2_replicas > 1:
+                try:
+                    l2cache.delete_many([replica_key(key, r) for r in range(1, l2_replicas)])
+                except:
+                    pass
+            with lock:
+                pinned.pop(key, None)
+
+        l1wrapper = wrapper
+        make_l0_key = _make_l0_key
+
+        def wrapper(*args, **kwds):
+            # request scoped L0 caching, in front of L1, when inside request_cache()
+            l0 = getattr(_request_local, 'cache', None)
+            if l0 is None:
+                return l1wrapper(*args, **kwds)
+            try:
+                key = make_l0_key(user_function, args, kwds, inst_attr)
+                result = l0.get(key, l0)    # l0 used here as a unique not-found sentinel
+            except TypeError:
+                # unhashable arguments, such as an instance without a hash, skip L0
+                return l1wrapper(*args, **kwds)
+            if result is not l0:
+                return result
+            result = l1wrapper(*args, **kwds)
+            if none_cache or result is not None:
+                l0[key] = result
+            return result
+
         wrapper.__wrapped__ = user_function
         wrapper.invalidate = invalidate
         wrapper.cache_info = cache_info
         wrapper.cache_clear = cache_clear
+        wrapper.hot_keys = hot_keys
+        wrapper.l1_entry_bytes = l1_entry_bytes
         return update_wrapper(wrapper, user_function)
 
     return decorating_function
\ No newline at end of file
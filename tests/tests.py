@@ -14,8 +14,16 @@ Replace this with more appropriate tests for your application.
 # import sys
 # from weakref import proxy
 from random import choice
+from shutil import rmtree
+from tempfile import mkdtemp
+import os
+from time import sleep
+from itertools import count
 from django.test import TestCase
 from lru2cache import utils
+from lru2cache.middleware import RequestCacheMiddleware
+from lru2cache import replay, trace
+from lru2cache.disk import DiskCache
 from django.core.cache import get_cache
 
 l2 = get_cache('default')
@@ -126,6 +134,51 @@ class TestLRU(TestCase):
         self.assertEqual(l1_misses, 4)
         self.assertEqual(l1_currsize, 2)
 
+    def test_lru_array_engine(self):
+        def orig(x, y):
+            return 3 * x + y
+        f = utils.lru2cache(l1_maxsize=20, l2cache_name='dummy')(orig)
+        g = utils.lru2cache(l1_maxsize=20, l2cache_name='dummy', l1_engine='array')(orig)
+        domain = range(6)
+        for i in range(1000):
+            x, y = choice(domain), choice(domain)
+            self.assertEqual(g(x, y), orig(x, y))
+            f(x, y)
+        # both engines evict in the same order
+        self.assertEqual(g.cache_info(), f.cache_info())
+        self.assertTrue(g.l1_entry_bytes() < f.l1_entry_bytes())
+
+        for x in domain:
+            g.invalidate(x, 0)
+        for i in range(1000):
+            x, y = choice(domain), choice(domain)
+            self.assertEqual(g(x, y), orig(x, y))
+        self.assertEqual(g.cache_info().l1_currsize, 20)
+
+        g.cache_clear()
+        self.assertEqual(g.cache_info(),
+            utils._CacheInfo(l1_hits=0, l1_misses=0, l2_hits=0, l2_misses=0, l1_maxsize=20, l1_currsize=0))
+        self.assertEqual(g.l1_entry_bytes(), 0.0)
+
+        global f_cnt
+        @utils.lru2cache(l1_maxsize=2, l2cache_name='dummy', l1_engine='array')
+        def f(x):
+            global f_cnt
+            f_cnt += 1
+            return x*10
+        f_cnt = 0
+        for x in 7, 9, 7, 9, 7, 9, 8, 8, 8, 9, 9, 9, 8, 8, 8, 7:
+            #    *  *              *                          *
+            self.assertEqual(f(x), x*10)
+        self.assertEqual(f_cnt, 4)
+        self.assertEqual(f.cache_info(), (12, 4, 0, 4, 2, 2))
+
+        with self.assertRaises(ValueError):
+            utils.lru2cache(l1_engine='tuple')
+        for l1_maxsize, l1_policy in (None, 'lru'), (0, 'lru'), (128, 'gd'):
+            with self.assertRaises(ValueError):
+                utils.lru2cache(l1_maxsize=l1_maxsize, l1_policy=l1_policy, l1_engine='array')
+
     def test_lru_with_l1_maxsize_none(self):
         @utils.lru2cache(l1_maxsize=None, l2cache_name='dummy')
         def fib(n):
@@ -170,6 +223,52 @@ class TestLRU(TestCase):
         self.assertEqual(f.cache_info(),
             utils._CacheInfo(l1_hits=36, l1_misses=36, l2_hits=0, l2_misses=36, l1_maxsize=None, l1_currsize=9))
 
+    def test_gd_keeps_expensive_results(self):
+        calls = []
+        @utils.lru2cache(l1_maxsize=2, l1_policy='gd', l2cache_name='dummy')
+        def f(x):
+            calls.append(x)
+            if x == 0:
+                sleep(0.05)
+            return x*10
+        for x in 0, 1, 2, 3, 4, 0, 5, 6, 0:
+            self.assertEqual(f(x), x*10)
+        # the expensive result survives cheap misses that would have evicted it in an lru
+        self.assertEqual(calls, [0, 1, 2, 3, 4, 5, 6])
+        l1_hits, l1_misses, l2_hits, l2_misses, l1_maxsize, l1_currsize = f.cache_info()
+        self.assertEqual(l1_hits, 2)
+        self.assertEqual(l1_misses, 7)
+        self.assertEqual(l1_currsize, 2)
+
+        f.invalidate(0)
+        self.assertEqual(f(0), 0)
+        self.assertEqual(calls[-1], 0)
+        self.assertEqual(f.cache_info().l1_currsize, 2)
+
+        f.cache_clear()
+        self.assertEqual(f.cache_info(),
+            utils._CacheInfo(l1_hits=0, l1_misses=0, l2_hits=0, l2_misses=0, l1_maxsize=2, l1_currsize=0))
+
+    def test_l2_min_cost(self):
+        calls = []
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='default', l2_min_cost=60)
+        def cheap_l2_min_cost(x):
+            calls.append(x)
+            return x*10
+        for i in range(3):
+            self.assertEqual(cheap_l2_min_cost(1), 10)
+        # results cheaper than l2_min_cost are never added to the l2 cache
+        self.assertEqual(calls, [1, 1, 1])
+        self.assertEqual(cheap_l2_min_cost.cache_info(),
+            utils._CacheInfo(l1_hits=0, l1_misses=3, l2_hits=0, l2_misses=3, l1_maxsize=0, l1_currsize=0))
+
+    def test_invalid_l1_policy(self):
+        with self.assertRaises(ValueError):
+            utils.lru2cache(l1_policy='lfu')
+        for l1_maxsize in None, 0:
+            with self.assertRaises(ValueError):
+                utils.lru2cache(l1_maxsize=l1_maxsize, l1_policy='gd')
+
     ######################################################################
     '''
     These tests require remediation
@@ -306,6 +405,423 @@ class TestLRU(TestCase):
     #             self.assertIs(f_copy, f)
 
 
+class TestL3(TestCase):
+    def setUp(self):
+        self.l3_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.l3_dir)
+
+    def test_l3(self):
+        calls = []
+        def orig(x):
+            calls.append(x)
+            return [x] * 10
+        f = utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir,
+                            l3_min_bytes=0, l3_min_cost=0)(orig)
+        for x in 1, 2, 1, 2, 1:
+            self.assertEqual(f(x), [x] * 10)
+        self.assertEqual(calls, [1, 2])
+        info = f.cache_info()
+        self.assertEqual(info[:6], (0, 5, 0, 2, 0, 0))
+        self.assertEqual((info.l3_hits, info.l3_misses), (3, 2))
+        self.assertTrue(info.l3_latency > 0)
+        self.assertTrue(info.l3_currbytes > 0)
+
+        # the disk cache is shared, so another instance sees the same results
+        g = utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir,
+                            l3_min_bytes=0, l3_min_cost=0)(orig)
+        self.assertEqual(g(1), [1] * 10)
+        self.assertEqual(calls, [1, 2])
+
+        f.invalidate(1)
+        self.assertEqual(f(1), [1] * 10)
+        self.assertEqual(calls, [1, 2, 1])
+
+        f.cache_clear()
+        self.assertEqual(f.cache_info()[:8], (0, 0, 0, 0, 0, 0, 0, 0))
+
+    def test_l3_eviction(self):
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir, l3_maxbytes=2500,
+                         l3_min_bytes=0, l3_min_cost=0)
+        def f(x):
+            return b'x' * 1000
+        for x in range(5):
+            f(x)
+        self.assertEqual(f.cache_info().l3_currbytes, 2000)
+        f(4)
+        f(0)
+        self.assertEqual(f.cache_info().l3_hits, 1)
+
+    def test_l3_failed_writes(self):
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir,
+                         l3_min_bytes=0, l3_min_cost=0)
+        def f(x):
+            return lambda: x
+        # unpicklable results are returned but not stored
+        self.assertEqual(f(1)(), 1)
+        self.assertEqual(f(1)(), 1)
+        self.assertEqual(f.cache_info().l3_currbytes, 0)
+
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir,
+                         l3_min_bytes=0, l3_min_cost=0)
+        def g(x):
+            return x
+        # the directory disappearing makes writes fail
+        rmtree(self.l3_dir)
+        try:
+            self.assertEqual(g(1), 1)
+            self.assertEqual(g(1), 1)
+        finally:
+            os.mkdir(self.l3_dir)
+
+    def test_l3_admission(self):
+        calls = []
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir, l3_min_bytes=1000)
+        def f(x):
+            calls.append(x)
+            return b'x' * x
+        for x in 10, 10, 2000, 2000:
+            f(x)
+        # too small, and too cheap to compute
+        self.assertEqual(calls, [10, 10, 2000, 2000])
+        self.assertEqual(f.cache_info().l3_currbytes, 0)
+
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir, l3_min_bytes=1000,
+                         l3_min_cost=0.01)
+        def g(x):
+            calls.append(x)
+            sleep(0.02)
+            return b'x' * x
+        del calls[:]
+        for x in 10, 10, 2000, 2000:
+            g(x)
+        self.assertEqual(calls, [10, 10, 2000])
+        self.assertEqual(g.cache_info().l3_currbytes, 2000)
+
+    def test_l3_missing_index(self):
+        import threading
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir,
+                         l3_min_bytes=0, l3_min_cost=0)
+        def g(x):
+            return x
+        rmtree(self.l3_dir)
+        results = []
+        def call():
+            results.append((g(1), g.invalidate(1), g.cache_info().l3_currbytes))
+        try:
+            thread = threading.Thread(target=call)
+            thread.start()
+            thread.join()
+        finally:
+            os.mkdir(self.l3_dir)
+        self.assertEqual(results, [(1, None, None)])
+
+    def test_l3_currbytes(self):
+        l3 = DiskCache(self.l3_dir, 2500)
+        l3.set('a', b'x' * 1000)
+        l3.set('a', b'x' * 500)
+        l3.set('b', b'x' * 1000)
+        self.assertEqual(l3.currbytes(), 1500)
+        l3.delete('a')
+        self.assertEqual(l3.currbytes(), 1000)
+        for key in 'cdef':
+            l3.set(key, b'x' * 1000)
+        self.assertEqual(l3.currbytes(), 2000)
+        self.assertEqual([l3.get(key) is not None for key in 'bcdef'], [False, False, False, True, True])
+
+    def test_l3_zero_copy(self):
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', l3_dir=self.l3_dir, l3_zero_copy=True,
+                         l3_min_bytes=0, l3_min_cost=0)
+        def f(x):
+            return b'abc' * x
+        self.assertEqual(f(3), b'abcabcabc')
+        result = f(3)
+        self.assertIsInstance(result, memoryview)
+        self.assertEqual(result.tobytes(), b'abcabcabc')
+
+
+class TestL0(TestCase):
+    def test_request_cache(self):
+        self.n = 10
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy')
+        def f(x, y=1):
+            return x * self.n + y
+        with utils.request_cache():
+            for i in range(5):
+                self.assertEqual(f(1), 11)
+                self.assertEqual(f(1, y=2), 12)
+            with utils.request_cache():
+                self.assertEqual(f(1), 11)
+            self.assertEqual(f.cache_info().l1_misses, 2)
+
+            # read your writes after invalidating
+            self.n = 20
+            self.assertEqual(f(1), 11)
+            f.invalidate(1)
+            self.assertEqual(f(1), 21)
+            self.assertEqual(f.cache_info().l1_misses, 3)
+        self.assertEqual(f(1), 21)
+        self.assertEqual(f.cache_info().l1_misses, 4)
+
+    def test_request_cache_typed(self):
+        @utils.lru2cache(l1_maxsize=0, typed=True, l2cache_name='dummy')
+        def square(x):
+            return x * x
+        with utils.request_cache():
+            self.assertEqual(type(square(3)), type(9))
+            self.assertEqual(type(square(3.0)), type(9.0))
+            self.assertEqual(type(square(3)), type(9))
+        self.assertEqual(square.cache_info().l1_misses, 2)
+
+    def test_request_cache_untyped(self):
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy')
+        def square(x):
+            return x * x
+        with utils.request_cache():
+            for i in range(2):
+                self.assertEqual(type(square(3)), type(9))
+                self.assertEqual(type(square(3.0)), type(9.0))
+                self.assertEqual(type(square(True)), type(1))
+                self.assertEqual(type(square(x=3.0)), type(9.0))
+                self.assertEqual(type(square(x=3)), type(9))
+        self.assertEqual(square.cache_info().l1_misses, 5)
+
+    def test_request_cache_instances(self):
+        class X(object):
+            def __init__(self, id):
+                self.id = id
+            def __eq__(self, other):
+                return True
+            def __hash__(self):
+                return 0
+            @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy')
+            def f(self):
+                return self.id
+        with utils.request_cache():
+            self.assertEqual(X(1).f(), 1)
+            self.assertEqual(X(2).f(), 2)
+            self.assertEqual(X(1).f(), 1)
+        self.assertEqual(X.f.cache_info().l1_misses, 2)
+
+    def test_request_cache_instance_arguments(self):
+        class Model(object):
+            def __init__(self, id, name):
+                self.id = id
+                self.name = name
+            def __eq__(self, other):
+                return self.id == other.id
+            def __hash__(self):
+                return hash(self.id)
+            def __repr__(self):
+                return '<Model {i} {n}>'.format(i=self.id, n=self.name)
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy')
+        def name(model):
+            return model.name
+        with utils.request_cache():
+            self.assertEqual(name(Model(1, 'a')), 'a')
+            self.assertEqual(name(Model(1, 'b')), 'b')
+            self.assertEqual(name(Model(1, 'a')), 'a')
+        self.assertEqual(name.cache_info().l1_misses, 2)
+
+    def test_request_cache_clear(self):
+        self.n = 10
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy')
+        def f(x):
+            return x * self.n
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy')
+        def g(x):
+            return x * self.n
+        with utils.request_cache():
+            self.assertEqual(f(1), 10)
+            self.assertEqual(g(1), 10)
+            self.n = 20
+            f.cache_clear()
+            self.assertEqual(f(1), 20)
+            self.assertEqual(g(1), 10)
+
+    def test_middleware(self):
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy')
+        def f(x):
+            return x
+        middleware = RequestCacheMiddleware()
+        response = object()
+        middleware.process_request(None)
+        f(1)
+        f(1)
+        self.assertIs(middleware.process_response(None, response), response)
+        f(1)
+        self.assertEqual(f.cache_info().l1_misses, 2)
+        middleware.process_request(None)
+        f(1)
+        middleware.process_exception(None, Exception())
+        f(1)
+        self.assertEqual(f.cache_info().l1_misses, 4)
+
+
+class TestTrace(TestCase):
+    def setUp(self):
+        self.trace_dir = mkdtemp()
+        self.trace_file = os.path.join(self.trace_dir, 'trace.bin')
+
+    def tearDown(self):
+        rmtree(self.trace_dir)
+
+    def test_trace(self):
+        @utils.lru2cache(l1_maxsize=2, l2cache_name='dummy', trace_file=self.trace_file, trace_rate=1.0)
+        def f(x):
+            return x or None
+        for x in 7, 9, 7, 0, 8, 7:
+            f(x)
+        accesses = list(trace.read_trace(self.trace_file))
+        self.assertEqual([record.tier for record, rate in accesses],
+                         [trace.COMPUTED, trace.COMPUTED, trace.L1, trace.COMPUTED, trace.COMPUTED, trace.L1])
+        self.assertEqual([record.none_result for record, rate in accesses],
+                         [False, False, False, True, False, False])
+        record, rate = accesses[0]
+        self.assertEqual(record.function, __name__ + '.f')
+        self.assertEqual(record.pid, os.getpid())
+        self.assertEqual(rate, 1.0)
+
+        # an unbounded L1 only misses on the first call for each key
+        result, = replay.simulate(accesses, None)
+        self.assertEqual(result[2:6], (6, 2, 0, 4))
+        result, = replay.simulate(accesses, 2)
+        self.assertEqual(result[2:6], (6, 2, 0, 4))
+        result, = replay.simulate(accesses, 1)
+        self.assertEqual(result[2:6], (6, 0, 2, 4))
+        result, = replay.simulate(accesses, 0, none_cache=True)
+        self.assertEqual(result[2:6], (6, 0, 2, 4))
+
+    def test_trace_none_results(self):
+        @utils.lru2cache(l1_maxsize=0, none_cache=True, l2cache_name='default',
+                         trace_file=self.trace_file, trace_rate=1.0)
+        def trace_none_results(x):
+            return None
+        for i in range(5):
+            self.assertIsNone(trace_none_results(1))
+        self.assertEqual(trace_none_results.cache_info()[:4], (0, 5, 0, 5))
+        accesses = list(trace.read_trace(self.trace_file))
+        result, = replay.simulate(accesses, 0, none_cache=True)
+        self.assertEqual(result[2:6], (5, 0, 0, 5))
+        result, = replay.simulate(accesses, 2, none_cache=True)
+        self.assertEqual(result[2:6], (5, 4, 0, 1))
+
+    def test_trace_failures(self):
+        for trace_file in '/dev/full', os.path.join(self.trace_dir, 'missing', 'trace.bin'):
+            @utils.lru2cache(l1_maxsize=2, l2cache_name='dummy', trace_file=trace_file, trace_rate=1.0)
+            def f(x):
+                return x
+            self.assertEqual(f(1), 1)
+            self.assertEqual(f(1), 1)
+
+    def test_trace_sizes(self):
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', trace_file=self.trace_file, trace_rate=1.0)
+        def f(x):
+            return [{'value': 'x' * 1000} for i in range(x)]
+        f(10)
+        (record, rate), = trace.read_trace(self.trace_file)
+        self.assertTrue(record.size > 10000)
+
+    def test_trace_sampling(self):
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='dummy', trace_file=self.trace_file, trace_rate=0.5)
+        def f(x):
+            return x
+        for x in range(200):
+            f(x)
+            f(x)
+        accesses = list(trace.read_trace(self.trace_file))
+        self.assertTrue(0 < len(accesses) < 400)
+        self.assertEqual(len(accesses) % 2, 0)
+        self.assertTrue(all(rate == 0.5 for record, rate in accesses))
+
+
+class TestHotKeys(TestCase):
+    def test_pinning(self):
+        calls = []
+        @utils.lru2cache(l1_maxsize=1, l2cache_name='dummy', hot_threshold=3, hot_maxpins=1)
+        def f(x):
+            calls.append(x)
+            return x*10
+        for x in 1, 2, 1, 2, 1, 3, 1, 2, 1, 3, 1:
+            self.assertEqual(f(x), x*10)
+        # 1 is pinned after its third L1 miss and is no longer computed
+        self.assertEqual(calls, [1, 2, 1, 2, 1, 3, 2, 3])
+        # pinned calls are L1 hits, but still counted towards the key's estimate
+        self.assertEqual(f.cache_info()[:4], (3, 8, 0, 8))
+        key = utils._make_key(f.__wrapped__, (1,), {}, False)
+        self.assertEqual(f.hot_keys(), [(key, 6)])
+
+        f.invalidate(1)
+        self.assertEqual(f.hot_keys(), [])
+        f.cache_clear()
+        self.assertEqual(f.hot_keys(), [])
+
+    def test_pinned_keys_stay_pinned(self):
+        calls = []
+        fillers = count()
+        @utils.lru2cache(l1_maxsize=1, l2cache_name='dummy', hot_threshold=3, hot_maxpins=1)
+        def f(x):
+            calls.append(x)
+            return x
+        for i in range(20):
+            for j in range(10):
+                f('a')
+                f(next(fillers))
+            f('b')
+            f(next(fillers))
+        # a colder key going on missing L1 doesn't displace the hottest
+        self.assertEqual(calls.count('a'), 3)
+        self.assertEqual(calls.count('b'), 20)
+
+    def test_pinning_traced(self):
+        trace_dir = mkdtemp()
+        trace_file = os.path.join(trace_dir, 'trace.bin')
+        try:
+            @utils.lru2cache(l1_maxsize=1, l2cache_name='dummy', hot_threshold=2,
+                             trace_file=trace_file, trace_rate=1.0)
+            def f(x):
+                return x
+            for i in range(10):
+                f(1)
+                f(2)
+            self.assertEqual(f.cache_info()[:4], (16, 4, 0, 4))
+            accesses = list(trace.read_trace(trace_file))
+            self.assertEqual([record.tier for record, rate in accesses], [trace.COMPUTED] * 4 + [trace.L1] * 16)
+            result, = replay.simulate(accesses, 1)
+            self.assertEqual(result.calls, 20)
+        finally:
+            rmtree(trace_dir)
+
+    def test_l2_replicas(self):
+        @utils.lru2cache(l1_maxsize=0, l2cache_name='default', hot_threshold=1, hot_maxpins=0, l2_replicas=3)
+        def hot_l2_replicas(x):
+            return x*10
+        key = utils._make_key(hot_l2_replicas.__wrapped__, (1,), {}, False)
+        replicas = [key, '{k}:1'.format(k=key), '{k}:2'.format(k=key)]
+        self.assertEqual(hot_l2_replicas(1), 10)
+        self.assertEqual(l2.get_many(replicas), dict((k, 10) for k in replicas))
+        for i in range(10):
+            self.assertEqual(hot_l2_replicas(1), 10)
+        self.assertEqual(hot_l2_replicas.cache_info()[:4], (0, 11, 10, 1))
+        hot_l2_replicas.invalidate(1)
+        self.assertEqual(l2.get_many(replicas), {})
+
+    def test_sketch(self):
+        from lru2cache.hotkeys import CountMinSketch
+        sketch = CountMinSketch(width=64, decay_interval=100)
+        keys = [utils._make_key(py_cached_func, (i,), {}, False) for i in range(20)]
+        for i in range(5):
+            sketch.add(keys[0])
+        for key in keys[1:]:
+            sketch.add(key)
+        self.assertTrue(sketch.estimate(keys[0]) >= 5)
+        self.assertTrue(all(sketch.estimate(key) >= 1 for key in keys))
+        for i in range(100):
+            sketch.add(keys[1])
+        self.assertTrue(sketch.estimate(keys[0]) < 5)
+
+
 @utils.lru2cache(l2cache_name = 'dummy')
 def py_cached_func(x, y):
     return 3 * x + y